@@ -5,155 +5,380 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import random
-import json
+import orjson
 import os
 import hashlib
+import hmac
+import pickle
+import threading
+from collections import defaultdict
 from datetime import datetime, timedelta
 from io import BytesIO
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from question import Question
 
 # ============================================================================
 # НАСТРОЙКИ
 # ============================================================================
 DATA_FILE = 'test_teoriya.xlsx'
 USERS_FILE = 'users.json'
-RESULTS_FILE = 'results.json'
+RESULTS_FILE = 'results.jsonl'
+LEGACY_RESULTS_FILE = 'results.json'
+CACHE_DIR = '.cache'
+FONT_FILE = 'DejaVuSans.ttf'
+QUESTIONS_CACHE_VERSION = 2  # увеличивать при изменении формата Question
+WRITE_BUFFER_SIZE = 1 << 20
 
 # ============================================================================
 # ЗАГРУЗКА ДАННЫХ ИЗ EXCEL
 # ============================================================================
+def read_questions_sheet():
+    """Чтение листа с вопросами (calamine, при его отсутствии — openpyxl)"""
+    try:
+        return pd.read_excel(DATA_FILE, sheet_name='теория', engine='calamine')
+    except ImportError:
+        return pd.read_excel(DATA_FILE, sheet_name='теория', engine='openpyxl')
+
+def text_column(df, col, strip=True):
+    """Столбец как массив строк (пустая строка, если столбца нет)"""
+    if col not in df.columns:
+        return np.full(len(df), '', dtype=object)
+    # Пустые ячейки -> '' (в pandas 3 astype(str) оставляет NaN как есть)
+    values = df[col].fillna('').astype(str)
+    if strip:
+        values = values.str.strip()
+    return values.to_numpy(dtype=object)
+
+def parse_questions():
+    """Разбор вопросов из Excel файла"""
+    try:
+        df = read_questions_sheet()
+    except Exception as e:
+        st.error(f"❌ Ошибка загрузки Excel: {e}")
+        return []
+    
+    df = df.dropna(subset=['Правильный ответ'])
+    option_cols = [f'Вариант {i}' for i in range(1, 6) if f'Вариант {i}' in df.columns]
+    if df.empty or not option_cols:
+        return []
+    
+    # Матрица вариантов: пустые ячейки -> None
+    options = df[option_cols].astype('string').apply(lambda s: s.str.strip())
+    present = options.notna().to_numpy()
+    options = options.to_numpy(dtype=object, na_value=None)
+    correct_text = df['Правильный ответ'].astype('string').str.strip().to_numpy(dtype=object)
+    
+    # Номер правильного варианта считается среди непустых вариантов
+    matches = (options == correct_text[:, None]) & present
+    found = matches.any(axis=1)
+    first_match = matches.argmax(axis=1)
+    correct_idx = np.where(found, present.cumsum(axis=1)[np.arange(len(df)), first_match], 0)
+    
+    nums = text_column(df, 'Номер вопроса', strip=False)[found]
+    texts = text_column(df, 'Текст вопроса')[found]
+    sections = text_column(df, 'Раздел')[found]
+    option_lists = [tuple(o for o in row if o is not None) for row in options[found]]
+    
+    questions = [
+        Question(num, text, opts, int(idx), section)
+        for num, text, opts, idx, section
+        in zip(nums, texts, option_lists, correct_idx[found], sections)
+    ]
+    
+    return questions
+
+def questions_cache_path():
+    """Путь к кешу вопросов на диске (по хешу содержимого Excel файла)"""
+    with open(DATA_FILE, 'rb') as f:
+        data_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f'questions_{QUESTIONS_CACHE_VERSION}_{data_hash}.pkl')
+
+def save_questions_cache(cache_path, questions):
+    """Сохранение кеша вопросов и удаление устаревших файлов кеша"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    atomic_write(cache_path, pickle.dumps(questions, protocol=5))
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.startswith('questions_') and path != cache_path:
+            os.remove(path)
+
 @st.cache_data
 def load_data():
-    """Загрузка вопросов из Excel файла"""
+    """Загрузка вопросов (из кеша на диске или из Excel файла)"""
     try:
-        df = pd.read_excel(DATA_FILE, sheet_name='теория', engine='openpyxl')
-    except Exception as e:
+        cache_path = questions_cache_path()
+    except OSError as e:
         st.error(f"❌ Ошибка загрузки Excel: {e}")
         return []
     
-    questions = []
-    for _, row in df.iterrows():
-        if pd.isna(row.get('Правильный ответ', '')):
-            continue
-        
-        options = []
-        for i in range(1, 6):
-            col = f'Вариант {i}'
-            if col in row and pd.notna(row.get(col, '')):
-                options.append(str(row[col]).strip())
-        
-        correct_text = str(row['Правильный ответ']).strip()
+    if os.path.exists(cache_path):
         try:
-            correct_idx = options.index(correct_text) + 1
-        except ValueError:
-            continue
-        
-        question = {
-            'num': str(row.get('Номер вопроса', '')),
-            'text': str(row.get('Текст вопроса', '')).strip(),
-            'options': options,
-            'correct': correct_idx,
-            'section': str(row.get('Раздел', '')).strip()
-        }
-        questions.append(question)
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Ошибка чтения кеша вопросов: {e}")
     
+    questions = parse_questions()
+    if questions:
+        try:
+            save_questions_cache(cache_path, questions)
+        except OSError as e:
+            print(f"Ошибка записи кеша вопросов: {e}")
     return questions
 
+@st.cache_resource
+def load_questions_by_num():
+    """Словарь {номер: вопрос}; Question неизменяем, поэтому объект общий, без копирования"""
+    return {q.num: q for q in load_data()}
+
 # ============================================================================
 # УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ
 # ============================================================================
-def load_users():
-    """Загрузка данных пользователей из JSON"""
-    if not os.path.exists(USERS_FILE):
-        default_users = {
-            "admin": {
-                "hash": hashlib.sha256("admin123".encode()).hexdigest(),
-                "fullname": "Администратор",
-                "is_active": True,
-                "is_admin": True,
-                "registered_at": datetime.now().isoformat(),
-                "last_login": None,
-                "tests_taken": 0
-            }
-        }
-        save_users(default_users)
-        return default_users
-    
+def file_stat_key(path):
+    """Ключ кеша для файла: (время изменения, размер) или None, если файла нет"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def atomic_write(path, data):
+    """Запись через временный файл и os.replace: при сбое старый файл остаётся целым"""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Не оставляем недописанный временный файл
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    # fsync каталога, чтобы сам os.replace пережил сбой питания
+    # (на Windows каталог так не открыть — там пропускаем)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+@st.cache_resource
+def file_lock(path):
+    """Блокировка файла, общая для всех сессий процесса (чтение-изменение-запись)"""
+    return threading.RLock()
+
+@st.cache_data
+def read_users(stat_key):
+    """Разбор users.json (stat_key — ключ кеша); None, если файл пуст или повреждён"""
     try:
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
+        with open(USERS_FILE, 'rb') as f:
             content = f.read().strip()
-            if not content:
-                return load_users()
-            users = json.loads(content)
-            if not isinstance(users, dict):
-                return load_users()
-            return users
+        users = orjson.loads(content) if content else None
     except Exception as e:
         print(f"Ошибка загрузки пользователей: {e}")
-        return load_users()
+        return None
+    return users if isinstance(users, dict) else None
+
+class UsersFileError(Exception):
+    """users.json существует, но не читается: перезаписывать его нельзя"""
+
+def load_users():
+    """Загрузка данных пользователей из JSON"""
+    stat_key = file_stat_key(USERS_FILE)
+    if stat_key is not None:
+        users = read_users(stat_key)
+        if users is None:
+            # Повреждённый файл не подменяем пользователями по умолчанию,
+            # иначе следующая запись затрёт все учётные записи
+            raise UsersFileError(f"Файл {USERS_FILE} повреждён — исправьте его вручную")
+        return users
+    
+    # Файла нет — создаём его с администратором по умолчанию;
+    # scrypt считаем только здесь, а не при каждом вызове
+    with file_lock(USERS_FILE):
+        if not os.path.exists(USERS_FILE):
+            salt, admin_hash = hash_password("admin123")
+            default_users = {
+                "admin": {
+                    "salt": salt,
+                    "hash": admin_hash,
+                    "fullname": "Администратор",
+                    "is_active": True,
+                    "is_admin": True,
+                    "registered_at": datetime.now().isoformat(),
+                    "last_login": None,
+                    "tests_taken": 0
+                }
+            }
+            save_users(default_users)
+            return default_users
+    # Файл успел создать другой сеанс — читаем его
+    return load_users()
 
 def save_users(users):
     """Сохранение данных пользователей в JSON"""
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+    # Сериализация целиком (orjson) + один write вместо множества мелких записей
+    with file_lock(USERS_FILE):
+        atomic_write(USERS_FILE, orjson.dumps(users, option=orjson.OPT_INDENT_2))
+        read_users.clear()
 
-def hash_password(password):
-    """Хеширование пароля"""
-    return hashlib.sha256(password.encode()).hexdigest()
+def hash_password(password, salt=None):
+    """Хеширование пароля (scrypt с солью); возвращает (соль, хеш) в hex"""
+    if salt is None:
+        salt = os.urandom(16).hex()
+    digest = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=2**14, r=8, p=1)
+    return salt, digest.hex()
+
+def verify_password(user, password):
+    """Проверка пароля; старые записи (SHA-256 без соли) тоже принимаются"""
+    salt = user.get('salt')
+    if salt is None:
+        expected = hashlib.sha256(password.encode()).hexdigest()
+    else:
+        expected = hash_password(password, salt)[1]
+    return hmac.compare_digest(user.get('hash', ''), expected)
 
 def register_user(username, password, fullname):
     """Регистрация нового пользователя"""
-    users = load_users()
-    if username in users:
-        return False, "❌ Логин уже занят"
-    users[username] = {
-        "hash": hash_password(password),
-        "fullname": fullname.strip(),
-        "is_active": False,
-        "is_admin": False,
-        "registered_at": datetime.now().isoformat(),
-        "last_login": None,
-        "tests_taken": 0
-    }
-    save_users(users)
+    salt, password_hash = hash_password(password)
+    with file_lock(USERS_FILE):
+        try:
+            users = load_users()
+        except UsersFileError as e:
+            return False, f"❌ {e}"
+        if username in users:
+            return False, "❌ Логин уже занят"
+        users[username] = {
+            "salt": salt,
+            "hash": password_hash,
+            "fullname": fullname.strip(),
+            "is_active": False,
+            "is_admin": False,
+            "registered_at": datetime.now().isoformat(),
+            "last_login": None,
+            "tests_taken": 0
+        }
+        save_users(users)
     return True, "✅ Регистрация отправлена. Ожидайте подтверждения администратора!"
 
 def login_user(username, password):
     """Вход пользователя в систему"""
-    users = load_users()
+    try:
+        users = load_users()
+    except UsersFileError as e:
+        return False, f"❌ {e}"
     if username not in users:
         return False, "❌ Пользователь не найден"
     user = users[username]
-    if user["hash"] != hash_password(password):
+    if not verify_password(user, password):
         return False, "❌ Неверный пароль"
     if not user.get("is_active", False) and not user.get("is_admin", False):
         return False, "⏳ Аккаунт ожидает подтверждения администратора"
     
-    # Записываем время последнего входа
-    users[username]['last_login'] = datetime.now().isoformat()
-    save_users(users)
+    # Записываем время последнего входа; старый SHA-256 заменяем на scrypt
+    with file_lock(USERS_FILE):
+        try:
+            users = load_users()
+        except UsersFileError as e:
+            return False, f"❌ {e}"
+        if username in users:
+            if 'salt' not in users[username]:
+                users[username]['salt'], users[username]['hash'] = hash_password(password)
+            users[username]['last_login'] = datetime.now().isoformat()
+            save_users(users)
     
     return True, "✅ Вход выполнен!"
 
 # ============================================================================
 # УПРАВЛЕНИЕ РЕЗУЛЬТАТАМИ ТЕСТОВ
 # ============================================================================
+def migrate_legacy_results():
+    """Однократный перенос результатов из results.json (JSON-массив) в results.jsonl"""
+    if not os.path.exists(LEGACY_RESULTS_FILE):
+        return
+    with file_lock(RESULTS_FILE):
+        # Проверяем ещё раз под блокировкой: другая сессия могла уже перенести файл.
+        # Непустой results.jsonl не трогаем, пустой — заполняем из старого файла
+        if not os.path.exists(LEGACY_RESULTS_FILE):
+            return
+        if os.path.exists(RESULTS_FILE) and os.path.getsize(RESULTS_FILE) > 0:
+            return
+        try:
+            with open(LEGACY_RESULTS_FILE, 'rb') as f:
+                content = f.read().strip()
+            legacy = orjson.loads(content) if content else []
+        except Exception as e:
+            print(f"Ошибка переноса результатов: {e}")
+            return
+        save_results(legacy if isinstance(legacy, list) else [])
+        os.replace(LEGACY_RESULTS_FILE, LEGACY_RESULTS_FILE + '.bak')
+
+@st.cache_data
+def read_results(stat_key):
+    """Разбор файла результатов (stat_key — ключ кеша)"""
+    results = []
+    with open(RESULTS_FILE, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                results.append(orjson.loads(line))
+            except ValueError as e:
+                print(f"Ошибка чтения результата: {e}")
+    return results
+
 def load_results():
-    """Загрузка результатов тестов из JSON"""
-    if not os.path.exists(RESULTS_FILE):
-        return []
-    try:
-        with open(RESULTS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
+    """Загрузка результатов тестов из JSONL (одна сессия на строку)"""
+    stat_key = file_stat_key(RESULTS_FILE)
+    if stat_key is None:
         return []
+    return read_results(stat_key)
+
+@st.cache_data
+def group_results_by_user(stat_key):
+    """Сессии тестов, сгруппированные по пользователю (stat_key — ключ кеша)"""
+    by_user = defaultdict(list)
+    for result in read_results(stat_key):
+        by_user[result.get('user')].append(result)
+    return dict(by_user)
+
+def load_results_by_user():
+    """Словарь {пользователь: [сессии]} для выборки истории за O(1)"""
+    stat_key = file_stat_key(RESULTS_FILE)
+    if stat_key is None:
+        return {}
+    return group_results_by_user(stat_key)
+
+def clear_results_cache():
+    """Сброс всех кешей, построенных по файлу результатов"""
+    read_results.clear()
+    group_results_by_user.clear()
+    build_answers_df.clear()
+
+def save_results(all_results):
+    """Полная перезапись файла результатов (например, при удалении пользователя)"""
+    with file_lock(RESULTS_FILE):
+        atomic_write(RESULTS_FILE, b''.join(orjson.dumps(r) + b'\n' for r in all_results))
+        clear_results_cache()
 
 def save_result(user, score, total, correct_count, results, time_used):
-    """Сохранение результата теста"""
+    """Сохранение результата теста (дозапись одной строки в JSONL)"""
     result = {
         'user': user,
         'timestamp': datetime.now().isoformat(),
@@ -163,21 +388,54 @@ def save_result(user, score, total, correct_count, results, time_used):
         'time_used': str(time_used),
         'results': results
     }
-    all_results = load_results()
-    all_results.append(result)
     
-    # Обновляем счётчик тестов пользователя
-    users = load_users()
-    if user in users:
-        users[user]['tests_taken'] = users[user].get('tests_taken', 0) + 1
-        save_users(users)
-    
-    with open(RESULTS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(all_results, f, ensure_ascii=False, indent=2)
+    # Обновляем счётчик тестов пользователя (результат сохраняем в любом случае)
+    with file_lock(USERS_FILE):
+        try:
+            users = load_users()
+        except UsersFileError as e:
+            print(f"Счётчик тестов не обновлён: {e}")
+            users = {}
+        if user in users:
+            users[user]['tests_taken'] = users[user].get('tests_taken', 0) + 1
+            save_users(users)
+    
+    with file_lock(RESULTS_FILE):
+        with open(RESULTS_FILE, 'ab') as f:
+            f.write(orjson.dumps(result) + b'\n')
+        clear_results_cache()
 
 # ============================================================================
 # РАСЧЁТ ПРОГРЕССА
 # ============================================================================
+def answers_frame(results):
+    """Плоская таблица ответов: одна строка на каждый ответ каждой сессии"""
+    records = [
+        {'user': session.get('user'), 'timestamp': session.get('timestamp'), **res}
+        for session in results
+        if isinstance(session, dict) and isinstance(session.get('results'), list)
+        for res in session['results']
+        if isinstance(res, dict)
+    ]
+    df = pd.DataFrame(records, columns=['user', 'timestamp', 'num', 'answered', 'is_correct'])
+    # Повторяющиеся строки — категории, флаг ответа — настоящий bool
+    df['user'] = df['user'].astype('category')
+    df['num'] = df['num'].astype('category')
+    df['is_correct'] = df['is_correct'].eq(True)
+    return df
+
+@st.cache_data
+def build_answers_df(stat_key):
+    """Плоская таблица ответов по всем сессиям (stat_key — ключ кеша)"""
+    return answers_frame(read_results(stat_key))
+
+def load_answers_df():
+    """Общая плоская таблица ответов для прогресса и админ-панели"""
+    stat_key = file_stat_key(RESULTS_FILE)
+    if stat_key is None:
+        return answers_frame([])
+    return build_answers_df(stat_key)
+
 def calculate_mastery(username):
     """Расчёт прогресса освоения вопросов"""
     all_questions = load_data()
@@ -185,77 +443,64 @@ def calculate_mastery(username):
     if total_in_db == 0:
         return 0, 0, 0, []
     
-    results = load_results()
-    mastered_question_nums = set()
-    section_stats = {}
-    
-    # Безопасная обработка результатов
-    if not results or not isinstance(results, list):
-        results = []
-    
-    for test_session in results:
-        try:
-            # Проверяем, что это словарь и есть поле user
-            if not isinstance(test_session, dict):
-                continue
-            if test_session.get('user') != username:
-                continue
-            
-            # Обрабатываем результаты теста
-            test_results = test_session.get('results', [])
-            if not isinstance(test_results, list):
-                continue
-                
-            for res in test_results:
-                if not isinstance(res, dict):
-                    continue
-                if res.get('is_correct'):
-                    num = res.get('num')
-                    if num:
-                        mastered_question_nums.add(num)
-                        # Статистика по разделам
-                        q = next((q for q in all_questions if q['num'] == num), None)
-                        if q:
-                            sec = q['section']
-                            if sec not in section_stats:
-                                section_stats[sec] = {'correct': 0, 'total': 0}
-                            section_stats[sec]['correct'] += 1
-        except Exception as e:
-            print(f"Ошибка при обработке теста: {e}")
-            continue
-    
-    # Подсчёт общего количества вопросов по разделам
-    for q in all_questions:
-        sec = q['section']
-        if sec not in section_stats:
-            section_stats[sec] = {'correct': 0, 'total': 0}
-        section_stats[sec]['total'] += 1
+    answers = load_answers_df()
+    correct = answers[(answers['user'] == username) & answers['is_correct']]
+    mastered_question_nums = {num for num in correct['num'].unique() if num}
+    
+    # Статистика по разделам: освоенные вопросы / всего вопросов в разделе
+    questions_df = pd.DataFrame(all_questions)[['num', 'section']]
+    questions_df['section'] = questions_df['section'].astype('category')
+    questions_df['mastered'] = questions_df['num'].isin(mastered_question_nums)
+    section_stats = questions_df.groupby('section', sort=False, observed=True).agg(
+        correct=('mastered', 'sum'),
+        total=('num', 'size')
+    )
+    section_stats['percent'] = (section_stats['correct'] / section_stats['total'] * 100).round(1)
     
     mastered_count = len(mastered_question_nums)
     percent = round((mastered_count / total_in_db) * 100, 1) if total_in_db > 0 else 0
     
     # Прогресс по разделам в процентах
-    section_progress = []
-    for sec, stats in section_stats.items():
-        sec_percent = round((stats['correct'] / stats['total']) * 100, 1) if stats['total'] > 0 else 0
-        section_progress.append({
-            'section': sec,
-            'percent': sec_percent,
-            'correct': stats['correct'],
-            'total': stats['total']
-        })
+    section_progress = section_stats.reset_index()[['section', 'percent', 'correct', 'total']].to_dict('records')
     
     return mastered_count, total_in_db, percent, section_progress
 
 # ============================================================================
 # ГЕНЕРАЦИЯ PDF ОТЧЁТА
 # ============================================================================
-def generate_pdf_report(username, session_data):
-    """Генерация PDF отчёта с ошибками"""
+def register_pdf_font():
+    """Регистрация шрифта с кириллицей (один раз на процесс)"""
+    if 'DejaVu' in pdfmetrics.getRegisteredFontNames():
+        return 'DejaVu'
+    try:
+        pdfmetrics.registerFont(TTFont('DejaVu', FONT_FILE))
+    except Exception as e:
+        print(f"Ошибка загрузки шрифта {FONT_FILE}: {e}")
+        return 'Helvetica'
+    return 'DejaVu'
+
+@st.cache_resource
+def load_pdf_styles():
+    """Стили PDF отчёта со шрифтом DejaVu (создаются один раз на процесс, а не на каждый отчёт)"""
+    font = register_pdf_font()
+    styles = getSampleStyleSheet()
+    for name in ('Heading1', 'Heading2', 'Normal'):
+        styles[name].fontName = font
+    table_style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('FONTNAME', (0, 0), (-1, -1), font),
+    ])
+    return styles, table_style
+
+def generate_pdf_report(username, session_data, questions=None):
+    """Генерация PDF отчёта с ошибками (questions — словарь {номер: вопрос})"""
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4)
     elements = []
-    styles = getSampleStyleSheet()
+    styles, table_style = load_pdf_styles()
     
     elements.append(Paragraph(f"📊 Отчёт о тестировании", styles['Heading1']))
     elements.append(Paragraph(f"Пользователь: {username}", styles['Normal']))
@@ -268,26 +513,23 @@ def generate_pdf_report(username, session_data):
         elements.append(Paragraph("❌ Работа над ошибками:", styles['Heading2']))
         data = [['№', 'Вопрос', 'Ваш ответ', 'Правильный ответ']]
         
-        questions = {q['num']: q for q in load_data()}
+        if questions is None:
+            questions = load_questions_by_num()
         for res in wrong:
-            q = questions.get(res['num'], {})
-            user_ans = q['options'][res['answered']-1] if 0 < res['answered'] <= len(q.get('options', [])) else "Не выбран"
-            correct_ans = q['options'][q['correct']-1] if 0 < q.get('correct', 0) <= len(q.get('options', [])) else "Н/Д"
+            q = questions.get(res['num'])
+            options = q.options if q else ()
+            text = q.text if q else ''
+            user_ans = options[res['answered']-1] if 0 < res['answered'] <= len(options) else "Не выбран"
+            correct_ans = options[q.correct-1] if q and 0 < q.correct <= len(options) else "Н/Д"
             data.append([
                 res['num'],
-                (q.get('text', '')[:50] + "...") if len(q.get('text', '')) > 50 else q.get('text', ''),
+                (text[:50] + "...") if len(text) > 50 else text,
                 user_ans[:35] + "..." if len(user_ans) > 35 else user_ans,
                 correct_ans[:35] + "..." if len(correct_ans) > 35 else correct_ans
             ])
         
         table = Table(data, colWidths=[40, 180, 130, 130])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ]))
+        table.setStyle(table_style)
         elements.append(table)
     else:
         elements.append(Paragraph("🎉 Ошибок нет! Отличный результат!", styles['Normal']))
@@ -296,24 +538,23 @@ def generate_pdf_report(username, session_data):
     buffer.seek(0)
     return buffer.getvalue()
 
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def cached_pdf_report(username, session_data):
+    """PDF отчёт по сохранённой сессии; ограниченный кеш, общий для всех сессий браузера"""
+    return generate_pdf_report(username, session_data)
+
 # ============================================================================
 # ОТБОР ВОПРОСОВ
 # ============================================================================
 def get_sampled_questions(questions, mode):
     """Формирование выборки вопросов для теста"""
     if mode == "По 10 из каждого раздела":
-        by_section = {}
-        for q in questions:
-            sec = q['section']
-            if sec not in by_section:
-                by_section[sec] = []
-            by_section[sec].append(q)
-        sampled = []
-        for sec, qs in by_section.items():
-            selected = random.sample(qs, min(10, len(qs)))
-            sampled.extend(selected)
-        random.shuffle(sampled)
-        return sampled
+        # Перемешиваем все вопросы, берём первые 10 из каждого раздела
+        # и перемешиваем итоговую выборку (разделы вперемешку)
+        sections = pd.Series([q.section for q in questions], dtype='category')
+        shuffled = sections.sample(frac=1)
+        selected = shuffled.groupby(shuffled, observed=True, sort=False).head(10).sample(frac=1).index
+        return [questions[i] for i in selected]
     return questions.copy()
 
 # ============================================================================
@@ -328,14 +569,20 @@ def show_auth():
         username = st.text_input("Логин", key="login_user")
         password = st.text_input("Пароль", type="password", key="login_pass")
         if st.button("Войти", key="btn_login", type="primary"):
-            success, msg = login_user(username, password)
-            if success:
-                st.session_state.logged_in = True
-                st.session_state.user = username
-                st.session_state.is_admin = load_users().get(username, {}).get('is_admin', False)
-                st.rerun()
+            # Пустые поля отсекаем до чтения users.json и вычисления scrypt
+            if not (username and password):
+                st.warning("⚠️ Введите логин и пароль")
             else:
-                st.error(msg)
+                success, msg = login_user(username, password)
+                if success:
+                    st.session_state.logged_in = True
+                    st.session_state.user = username
+                    user = load_users().get(username, {})
+                    st.session_state.is_admin = user.get('is_admin', False)
+                    st.session_state.fullname = user.get('fullname', '')
+                    st.rerun()
+                else:
+                    st.error(msg)
     
     with tab2:
         st.subheader("Регистрация нового пользователя")
@@ -363,50 +610,30 @@ def show_auth():
 # ============================================================================
 # АДМИН-ПАНЕЛЬ
 # ============================================================================
-def admin_user_management():
-    """Управление пользователями для администратора"""
-    st.subheader("👥 Управление пользователями")
-    
+@st.cache_data(max_entries=1)
+def build_users_table(users_key, results_key, total_in_db):
+    """Строки таблицы пользователей для админ-панели (ключи файлов — ключи кеша)"""
     users = load_users()
-    results = load_results()
-    all_questions = load_data()
+    results_by_user = load_results_by_user()
     
-    # Фильтры
-    col1, col2 = st.columns(2)
-    with col1:
-        filter_status = st.radio("Статус:", ["Все", "Активные", "Ожидают"], key="admin_filter_status", horizontal=True)
-    with col2:
-        search = st.text_input("🔍 Поиск по ФИО или логину", key="admin_search")
+    # Прогресс освоения: число разных верно отвеченных вопросов на пользователя
+    answers = load_answers_df()
+    mastered_counts = answers[answers['is_correct']].groupby('user', observed=True)['num'].nunique()
     
-    # Формируем таблицу данных
     table_data = []
     for username, data in users.items():
         if data.get('is_admin'):
             continue
         
-        # Применяем фильтры
-        if filter_status == "Активные" and not data.get('is_active'):
-            continue
-        if filter_status == "Ожидают" and data.get('is_active'):
-            continue
-        if search and search.lower() not in data.get('fullname', '').lower() and search.lower() not in username.lower():
-            continue
-        
         # Считаем активность и прогресс
-        user_results = [r for r in results if r['user'] == username]
+        user_results = results_by_user.get(username, [])
         tests_count = len(user_results)
         last_login = data.get('last_login', '—')
         if last_login and last_login != 'None':
             last_login = last_login[:16]
         
-        # Прогресс освоения
-        mastered = set()
-        for session in user_results:
-            for res in session['results']:
-                if res['is_correct']:
-                    mastered.add(res['num'])
-        total_in_db = len(all_questions)
-        progress = round((len(mastered) / total_in_db) * 100, 1) if total_in_db > 0 else 0
+        mastered = int(mastered_counts.get(username, 0))
+        progress = round((mastered / total_in_db) * 100, 1) if total_in_db > 0 else 0
         
         table_data.append({
             "ФИО": data.get('fullname', 'Не указано'),
@@ -418,6 +645,39 @@ def admin_user_management():
             "Прогресс": f"{progress}%",
             "actions": username
         })
+    return table_data
+
+def admin_user_management():
+    """Управление пользователями для администратора"""
+    st.subheader("👥 Управление пользователями")
+    
+    try:
+        users = load_users()
+    except UsersFileError as e:
+        st.error(f"❌ {e}")
+        return
+    
+    # Фильтры
+    col1, col2 = st.columns(2)
+    with col1:
+        filter_status = st.radio("Статус:", ["Все", "Активные", "Ожидают"], key="admin_filter_status", horizontal=True)
+    with col2:
+        search = st.text_input("🔍 Поиск по ФИО или логину", key="admin_search")
+    
+    # Таблица строится заново только при изменении users.json / results.jsonl
+    all_rows = build_users_table(file_stat_key(USERS_FILE), file_stat_key(RESULTS_FILE), len(load_data()))
+    
+    # Применяем фильтры
+    table_data = []
+    for row in all_rows:
+        data = users.get(row['actions'], {})
+        if filter_status == "Активные" and not data.get('is_active'):
+            continue
+        if filter_status == "Ожидают" and data.get('is_active'):
+            continue
+        if search and search.lower() not in data.get('fullname', '').lower() and search.lower() not in row['actions'].lower():
+            continue
+        table_data.append(row)
     
     # Отображение таблицы
     if table_data:
@@ -438,19 +698,32 @@ def admin_user_management():
                 
                 if not users[row['actions']].get('is_active'):
                     if col2.button("✅ Активировать", key=f"activate_{row['actions']}"):
-                        users[row['actions']]['is_active'] = True
-                        save_users(users)
-                        st.success(f"{row['ФИО']} активирован!")
-                        st.rerun()
+                        try:
+                            with file_lock(USERS_FILE):
+                                users = load_users()
+                                if row['actions'] in users:
+                                    users[row['actions']]['is_active'] = True
+                                    save_users(users)
+                        except UsersFileError as e:
+                            st.error(f"❌ {e}")
+                        else:
+                            st.success(f"{row['ФИО']} активирован!")
+                            st.rerun()
                 
                 if col3.button("🗑️ Удалить", key=f"delete_{row['actions']}", type="secondary"):
-                    del users[row['actions']]
-                    all_results = [r for r in results if r['user'] != row['actions']]
-                    with open(RESULTS_FILE, 'w', encoding='utf-8') as f:
-                        json.dump(all_results, f, ensure_ascii=False, indent=2)
-                    save_users(users)
-                    st.warning(f"{row['ФИО']} удалён")
-                    st.rerun()
+                    # Сначала пользователи: при повреждённом users.json результаты не трогаем
+                    try:
+                        with file_lock(USERS_FILE):
+                            users = load_users()
+                            users.pop(row['actions'], None)
+                            save_users(users)
+                    except UsersFileError as e:
+                        st.error(f"❌ {e}")
+                    else:
+                        with file_lock(RESULTS_FILE):
+                            save_results([r for r in load_results() if r['user'] != row['actions']])
+                        st.warning(f"{row['ФИО']} удалён")
+                        st.rerun()
     else:
         st.info("📭 Нет пользователей для отображения")
     
@@ -477,7 +750,8 @@ def user_dashboard():
     col1, col2, col3 = st.columns(3)
     col1.metric("📚 Освоено вопросов", f"{mastered}/{total}")
     col2.metric("🎯 Общий прогресс", f"{percent}%")
-    col3.metric("📊 Тестов пройдено", len([r for r in load_results() if r['user'] == username]))
+    history = load_results_by_user().get(username, [])
+    col3.metric("📊 Тестов пройдено", len(history))
     
     st.progress(percent / 100)
     
@@ -490,19 +764,24 @@ def user_dashboard():
     
     # История тестов
     st.subheader("📜 История тестов")
-    history = [r for r in load_results() if r['user'] == username]
     if history:
         for i, session in enumerate(reversed(history), 1):
             with st.expander(f"Тест #{i} — {session['timestamp'][:16]} — {session['correct']}/{session['total']} ({session['score']}%)"):
                 st.write(f"⏱️ Время: {session['time_used']}")
-                pdf_data = generate_pdf_report(username, session)
-                st.download_button(
-                    label="📄 Скачать PDF с ошибками",
-                    data=pdf_data,
-                    file_name=f"report_{username}_{session['timestamp'][:10]}.pdf",
-                    mime="application/pdf",
-                    key=f"pdf_{i}"
-                )
+                # PDF формируется только по запросу, а не при каждой отрисовке истории;
+                # в session_state храним лишь отметку, сами байты — в кеше cached_pdf_report
+                pdf_key = f"pdf_requested_{session['timestamp']}"
+                if pdf_key not in st.session_state:
+                    if st.button("📄 Сформировать PDF с ошибками", key=f"make_pdf_{i}"):
+                        st.session_state[pdf_key] = True
+                if pdf_key in st.session_state:
+                    st.download_button(
+                        label="📄 Скачать PDF с ошибками",
+                        data=cached_pdf_report(username, session),
+                        file_name=f"report_{username}_{session['timestamp'][:10]}.pdf",
+                        mime="application/pdf",
+                        key=f"pdf_{i}"
+                    )
     else:
         st.info("📭 Пока нет пройденных тестов")
 
@@ -533,6 +812,7 @@ def run_test():
             random.shuffle(test_questions)
         
         st.session_state.test_questions = test_questions
+        st.session_state.question_lookup = {q.num: q for q in test_questions}
         st.session_state.current_index = 0
         st.session_state.answers = []
         st.session_state.test_start_time = datetime.now()
@@ -563,41 +843,42 @@ def run_test():
         q = test_questions[idx]
         st.progress((idx + 1) / len(test_questions))
         st.write(f"### Вопрос {idx + 1} из {len(test_questions)}")
-        st.write(f"**{q['num']}**. {q['text']}")
+        st.write(f"**{q.num}**. {q.text}")
         
-        # Варианты ответов
-        answer = st.radio("Выберите ответ:", q['options'], key=f"q_{idx}", index=None)
+        # Вопрос в форме: выбор варианта не перезапускает страницу, только кнопки
+        is_last = idx == len(test_questions) - 1
+        with st.form(f"question_form_{idx}"):
+            # Радио возвращает сразу номер варианта (1..N)
+            answer = st.radio(
+                "Выберите ответ:",
+                range(1, len(q.options) + 1),
+                format_func=lambda i: q.options[i - 1],
+                key=f"q_{idx}",
+                index=None
+            )
+            
+            col1, col2 = st.columns(2)
+            back = idx > 0 and col1.form_submit_button("⬅️ Назад")
+            submitted = col2.form_submit_button("✅ Завершить тест" if is_last else "Далее ➡️", type="primary")
         
-        col1, col2 = st.columns(2)
-        if idx > 0 and col1.button("⬅️ Назад"):
+        if back:
             st.session_state.current_index -= 1
             st.rerun()
         
-        if idx < len(test_questions) - 1:
-            if col2.button("Далее ➡️", type="primary"):
-                if answer:
-                    selected_idx = q['options'].index(answer) + 1
-                    st.session_state.answers.append({
-                        'num': q['num'],
-                        'answered': selected_idx,
-                        'is_correct': (selected_idx == q['correct'])
-                    })
-                    st.session_state.current_index += 1
-                    st.rerun()
-                else:
-                    st.warning("⚠️ Выберите вариант ответа")
-        else:
-            if col2.button("✅ Завершить тест", type="primary"):
-                if answer:
-                    selected_idx = q['options'].index(answer) + 1
-                    st.session_state.answers.append({
-                        'num': q['num'],
-                        'answered': selected_idx,
-                        'is_correct': (selected_idx == q['correct'])
-                    })
+        if submitted:
+            if answer:
+                st.session_state.answers.append({
+                    'num': q.num,
+                    'answered': answer,
+                    'is_correct': (answer == q.correct)
+                })
+                if is_last:
                     finish_test()
                 else:
-                    st.warning("⚠️ Выберите вариант ответа")
+                    st.session_state.current_index += 1
+                    st.rerun()
+            else:
+                st.warning("⚠️ Выберите вариант ответа")
 
 def finish_test():
     """Завершение теста и сохранение результатов"""
@@ -606,8 +887,10 @@ def finish_test():
     start_time = st.session_state.test_start_time
     time_used = datetime.now() - start_time
     
-    correct_count = sum(1 for a in answers if a['is_correct'])
+    # Один проход по ответам: и счёт, и список ошибок
+    wrong = [a for a in answers if not a['is_correct']]
     total = len(answers)
+    correct_count = total - len(wrong)
     score = round((correct_count / total) * 100, 1) if total > 0 else 0
     
     save_result(username, score, total, correct_count, answers, time_used)
@@ -615,14 +898,13 @@ def finish_test():
     st.success(f"🎉 Тест завершён! Результат: {correct_count}/{total} ({score}%)")
     
     # Показать ошибки
-    wrong = [a for a in answers if not a['is_correct']]
+    questions = st.session_state.get('question_lookup') or load_questions_by_num()
     if wrong:
         st.subheader("❌ Ошибки:")
-        questions = {q['num']: q for q in load_data()}
         for a in wrong:
-            q = questions.get(a['num'], {})
-            st.write(f"**{a['num']}**. {q.get('text', '')[:100]}...")
-            st.write(f"   Ваш ответ: вариант {a['answered']} | Правильный: вариант {q.get('correct', '?')}")
+            q = questions.get(a['num'])
+            st.write(f"**{a['num']}**. {q.text[:100] if q else ''}...")
+            st.write(f"   Ваш ответ: вариант {a['answered']} | Правильный: вариант {q.correct if q else '?'}")
     
     # Кнопка скачивания PDF
     session_data = {
@@ -634,7 +916,7 @@ def finish_test():
         'time_used': str(time_used),
         'results': answers
     }
-    pdf_data = generate_pdf_report(username, session_data)
+    pdf_data = generate_pdf_report(username, session_data, questions)
     st.download_button(
         label="📄 Скачать полный отчёт (PDF)",
         data=pdf_data,
@@ -645,6 +927,7 @@ def finish_test():
     # Сброс
     st.session_state.in_test = False
     st.session_state.test_questions = []
+    st.session_state.question_lookup = {}
     st.session_state.answers = []
     
     if st.button("🏠 Вернуться в личный кабинет"):
@@ -657,6 +940,8 @@ def main():
     """Основная функция приложения"""
     st.set_page_config(page_title="🏢 Тест: Оценка недвижимости", page_icon="📚", layout="wide")
     
+    migrate_legacy_results()
+    
     if 'logged_in' not in st.session_state:
         st.session_state.update(logged_in=False, user=None, is_admin=False, in_test=False)
     
@@ -668,8 +953,7 @@ def main():
         # Боковая панель
         with st.sidebar:
             st.write(f"👤 **{st.session_state.user}**")
-            users = load_users()
-            fullname = users.get(st.session_state.user, {}).get('fullname', '')
+            fullname = st.session_state.get('fullname', '')
             if fullname:
                 st.write(f"📛 {fullname}")
             if st.session_state.is_admin:
@@ -0,0 +1,9 @@
+# ============================================================================
+# ВОПРОС ТЕСТА
+# ============================================================================
+# Отдельный модуль, а не app.py: Streamlit при каждом запуске скрипта создаёт
+# новый __main__, и pickle (st.cache_data, кеш на диске) не нашёл бы класс
+from collections import namedtuple
+
+# Вопрос теста; options — кортеж вариантов, correct — номер правильного (с 1)
+Question = namedtuple('Question', ['num', 'text', 'options', 'correct', 'section'])